@@ -26,11 +26,13 @@
      Manage conversion of data into CMake
 """
 
+import io
 import os
-from collections import OrderedDict
+from collections import Counter
+from functools import lru_cache
+from sys import intern
+from itertools import zip_longest
 from multiprocessing import Pool
-import shutil
-import copy
 
 from cmake_converter.data_files import get_cmake_lists
 from cmake_converter.flags import Flags
@@ -39,6 +41,14 @@ from cmake_converter.utils import write_comment, message, write_arch_types,\
 from cmake_converter.context import Context
 
 
+@lru_cache(maxsize=1)
+def get_utils_cmake_contents():
+    """ Reads the static utils.cmake template, once per process """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(src_dir, 'utils.cmake'), 'rb') as utils_file:
+        return utils_file.read()
+
+
 class DataConverter:
     """
         Base class for converters
@@ -78,10 +88,7 @@ class DataConverter:
 
     @staticmethod
     def __verify_configurations_to_parse(context):
-        absent_settings = set()
-        for setting in context.configurations_to_parse:
-            if setting not in context.settings:
-                absent_settings.add(setting)
+        absent_settings = set(context.configurations_to_parse) - context.settings.keys()
 
         if len(absent_settings) > 0:
             context.configurations_to_parse -= absent_settings
@@ -95,104 +102,170 @@ class DataConverter:
             return False
         return True
 
-    def merge_data_settings(self, context):
+    def merge_data_settings(self, context, keys_to_merge=None):
         """
         Merge common settings found among configuration settings (reduce copy-paste)
 
         :param context:
+        :param keys_to_merge: settings keys to merge, queried from context.utils when None
         :return:
         """
 
-        for key in context.utils.lists_of_settings_to_merge():
-            lists_of_items_to_merge = {}
-            set_of_items = {}
-
-            # get intersection pass
-            for sln_setting in context.sln_configurations_map:
-                mapped_setting = context.sln_configurations_map[sln_setting]
-                mapped_arch = sln_setting[1]
-                if mapped_arch is not None and mapped_arch not in lists_of_items_to_merge:
-                    lists_of_items_to_merge[mapped_arch] = OrderedDict()
-                if (None, mapped_arch) not in context.settings:
-                    context.current_setting = (None, mapped_arch)
-                    context.utils.init_context_current_setting(context)
+        if keys_to_merge is None:
+            keys_to_merge = context.utils.lists_of_settings_to_merge()
 
-                if key not in context.settings[mapped_setting] \
-                        or mapped_setting[0] is None:
-                    continue
-                settings_list = context.settings[mapped_setting][key]
-                if not lists_of_items_to_merge[mapped_arch]:  # first pass
-                    set_of_items[mapped_arch] = set(settings_list)
+        # configurations contributing to the merge, per arch: an arch with a
+        # single configuration needs no intersection or ordering passes
+        arch_counts = Counter(
+            sln_setting[1]
+            for sln_setting, mapped_setting in context.sln_configurations_map.items()
+            if mapped_setting[0] is not None
+        )
+        initialized_archs = set()
+        for key in keys_to_merge:
+            self.__merge_key_settings(context, key, arch_counts, initialized_archs)
 
-                lists_of_items_to_merge[mapped_arch][sln_setting] = settings_list
-                set_of_items[mapped_arch] = set_of_items[mapped_arch].intersection(
-                    set(context.settings[mapped_setting][key])
-                )
+        if context.file_contexts is not None:
+            for file in context.file_contexts:
+                self.merge_data_settings(context.file_contexts[file], keys_to_merge)
 
-            self.__remove_common_settings_from_context(
-                context,
-                lists_of_items_to_merge,
-                set_of_items,
-                key
-            )
+    def __merge_key_settings(self, context, key, arch_counts, initialized_archs):
+        """ Merges one settings key across the configurations of each arch """
+        lists_of_items_to_merge, set_of_items = self.__get_intersection_of_settings(
+            context, key, arch_counts, initialized_archs
+        )
 
-            merged_order_lists = self.__get_order_of_common_settings(lists_of_items_to_merge)
+        # freeze common items: read-only from here on, with cheaper probes
+        set_of_items = {
+            arch: frozenset(items) for arch, items in set_of_items.items()
+        }
 
-            merged_settings = self.__get_common_ordered_settings(
-                merged_order_lists,
-                set_of_items
-            )
+        self.__remove_common_settings_from_context(
+            context,
+            lists_of_items_to_merge,
+            set_of_items,
+            key
+        )
 
-            for arch in merged_settings:
-                merged_setting = merged_settings[arch]
-                context.settings[(None, arch)][key] = merged_setting
-                context.sln_configurations_map[(None, arch)] = (None, arch)
+        merged_order_lists = self.__get_order_of_common_settings(lists_of_items_to_merge)
 
-        if context.file_contexts is not None:
-            for file in context.file_contexts:
-                self.merge_data_settings(context.file_contexts[file])
+        merged_settings = self.__get_common_ordered_settings(
+            merged_order_lists,
+            set_of_items
+        )
+
+        settings = context.settings
+        sln_configurations_map = context.sln_configurations_map
+        for arch in merged_settings:
+            settings[(None, arch)][key] = merged_settings[arch]
+            sln_configurations_map[(None, arch)] = (None, arch)
+
+    def __get_intersection_of_settings(self, context, key, arch_counts, initialized_archs):
+        """ Intersection pass of the merge: collects the per-arch setting lists
+            and their common items; single-configuration archs are consolidated
+            directly since their whole list is common """
+        settings = context.settings
+        lists_of_items_to_merge = {}
+        set_of_items = {}
+        single_arch_merged = {}
+
+        for sln_setting in context.sln_configurations_map:
+            mapped_setting = context.sln_configurations_map[sln_setting]
+            mapped_arch = sln_setting[1]
+            if mapped_arch is not None and arch_counts[mapped_arch] > 1 \
+                    and mapped_arch not in lists_of_items_to_merge:
+                lists_of_items_to_merge[mapped_arch] = {}
+            if mapped_arch not in initialized_archs:
+                initialized_archs.add(mapped_arch)
+                if (None, mapped_arch) not in settings:
+                    context.current_setting = (None, mapped_arch)
+                    context.utils.init_context_current_setting(context)
+
+            mapped_settings = settings[mapped_setting]
+            if key not in mapped_settings \
+                    or mapped_setting[0] is None:
+                continue
+            # intern elements so the set/dict probes of the merge passes
+            # below can compare equal strings by identity
+            settings_list = [intern(element) for element in mapped_settings[key]]
+            mapped_settings[key] = settings_list
+            if arch_counts[mapped_arch] == 1:
+                # sole configuration of this arch: every item is common; the
+                # write is deferred as other map entries may still read the list
+                single_arch_merged[sln_setting] = list(dict.fromkeys(settings_list))
+                continue
+            if not lists_of_items_to_merge[mapped_arch]:  # first pass
+                set_of_items[mapped_arch] = set(settings_list)
+            else:
+                set_of_items[mapped_arch].intersection_update(settings_list)
+            lists_of_items_to_merge[mapped_arch][sln_setting] = settings_list
+
+        for sln_setting in single_arch_merged:
+            self.__update_settings_at_context(context, sln_setting, key, [])
+            settings[(None, sln_setting[1])][key] = single_arch_merged[sln_setting]
+            context.sln_configurations_map[(None, sln_setting[1])] = (None, sln_setting[1])
+
+        return lists_of_items_to_merge, set_of_items
 
     def __remove_common_settings_from_context(
             self, context, lists_of_items_to_merge, set_of_items, key
     ):
         """ Removing common settings from configurations """
         for arch in lists_of_items_to_merge:
-            for sln_setting in lists_of_items_to_merge[arch]:
-                result_settings_list = []
-                for element in lists_of_items_to_merge[arch][sln_setting]:
-                    if element not in set_of_items[arch]:
-                        result_settings_list.append(element)
+            arch_items_to_merge = lists_of_items_to_merge[arch]
+            common_items = set_of_items[arch]
+            for sln_setting in arch_items_to_merge:
+                result_settings_list = [
+                    element for element in arch_items_to_merge[sln_setting]
+                    if element not in common_items
+                ]
+                existing_setting = context.settings.get(sln_setting)
+                if existing_setting is not None \
+                        and existing_setting.get(key) == result_settings_list:
+                    # nothing removed for this setting: no clone/write needed
+                    context.sln_configurations_map[sln_setting] = sln_setting
+                    continue
                 self.__update_settings_at_context(
                     context, sln_setting, key, result_settings_list
                 )
 
     @staticmethod
-    def __update_settings_at_context(context, sln_setting, key, settings_to_set):
+    def __clone_setting(setting):
+        """ Typed clone of a setting dict (values are lists, sets, nested dicts or scalars) """
+        clone = {}
+        for setting_key, value in setting.items():
+            if isinstance(value, list):
+                value = list(value)
+            elif isinstance(value, dict):
+                value = DataConverter.__clone_setting(value)
+            elif isinstance(value, set):
+                value = set(value)
+            clone[setting_key] = value
+        return clone
+
+    def __update_settings_at_context(self, context, sln_setting, key, settings_to_set):
         if sln_setting not in context.settings:
             context.settings[sln_setting] = \
-                copy.deepcopy(context.settings[context.sln_configurations_map[sln_setting]])
+                self.__clone_setting(context.settings[context.sln_configurations_map[sln_setting]])
         context.sln_configurations_map[sln_setting] = sln_setting
         context.settings[sln_setting][key] = settings_to_set
 
     @staticmethod
     def __get_order_of_common_settings(lists_of_items_to_merge_arch):
         merged_order_lists = {}
+        sentinel = object()
         for arch in lists_of_items_to_merge_arch:
             lists_of_items_to_merge = lists_of_items_to_merge_arch[arch]
-            merged_order_lists[arch] = []
-            i = 0
-            while True:
-                out_of_bounds = 0
-                for setting in lists_of_items_to_merge:
-                    settings_list = lists_of_items_to_merge[setting]
-                    if i < len(settings_list):
-                        merged_order_lists[arch].append(settings_list[i])
-                    else:
-                        out_of_bounds += 1
-
-                if out_of_bounds == len(lists_of_items_to_merge):
-                    break
-                i += 1
+            merged_order_list = []
+            seen = set()
+            # round-robin over the setting lists, one element of each per row,
+            # keeping only the first occurrence of each element
+            for row in zip_longest(*lists_of_items_to_merge.values(), fillvalue=sentinel):
+                for element in row:
+                    if element is not sentinel and element not in seen:
+                        seen.add(element)
+                        merged_order_list.append(element)
+            merged_order_lists[arch] = merged_order_list
 
         return merged_order_lists
 
@@ -201,13 +274,20 @@ class DataConverter:
         common_ordered_lists = {}
         for arch in merged_order_list_arch:
             merged_order_list = merged_order_list_arch[arch]
-            common_ordered_lists[arch] = []
+            common_ordered_list = []
+            common_items = set_of_items.get(arch)
+            if not common_items:
+                # arch never contributed the merge key: nothing in common
+                common_ordered_lists[arch] = common_ordered_list
+                continue
+            remaining_items = set(common_items)
             for element in merged_order_list:
-                if element in set_of_items[arch]:
-                    common_ordered_lists[arch].append(element)
-                    set_of_items[arch].remove(element)
-                    if not set_of_items:
+                if element in common_items:
+                    common_ordered_list.append(element)
+                    remaining_items.discard(element)
+                    if not remaining_items:
                         break
+            common_ordered_lists[arch] = common_ordered_list
 
         return common_ordered_lists
 
@@ -267,13 +347,16 @@ class DataConverter:
         self.merge_data_settings(context)
         if context.dry:
             return True
-        if os.path.exists(context.cmake + '/CMakeLists.txt'):
-            cmake_file = get_cmake_lists(context, context.cmake, 'a')
+        # open in append mode unconditionally: tell() says whether the file
+        # already has content, saving the stat of an os.path.exists check
+        cmake_file = get_cmake_lists(context, context.cmake, 'a')
+        if cmake_file.tell() > 0:
             cmake_file.write('\n' * 26)
-        else:
-            cmake_file = get_cmake_lists(context, context.cmake)
         message(context, 'Writing data for project {}'.format(context.vcxproj_path), '')
-        self.write_data(context, cmake_file)
+        # collect the whole project output in memory, then write it in one go
+        buffer = io.StringIO()
+        self.write_data(context, buffer)
+        cmake_file.write(buffer.getvalue())
         cmake_file.close()
         warnings = ''
         if context.warnings_count > 0:
@@ -287,33 +370,36 @@ class DataConverter:
 
     def run_conversion(self, subdirectory_projects_data):
         """ Routine that converts projects located at the same directory """
-        results = []
-        for project_data in subdirectory_projects_data:
-            project_context = project_data['project_context']
-            name = project_context.project_number
-            message(project_context, '------ Starting {} -------'.format(name), '')
-            converted = self.convert_project(
-                project_context,
-                project_data['project_abs'],
-                project_data['subdirectory'],
-            )
-            message(project_context, '------ Exiting  {} -------'.format(name), '')
+        # projects of one subdirectory append to the same CMakeLists.txt and
+        # must keep list order, so they are converted strictly one by one
+        results = [
+            self.__convert_subdirectory_project(project_data)
+            for project_data in subdirectory_projects_data
+        ]
+        return [result for result in results if result is not None]
+
+    def __convert_subdirectory_project(self, project_data):
+        project_context = project_data['project_context']
+        name = project_context.project_number
+        message(project_context, '------ Starting {} -------'.format(name), '')
+        converted = self.convert_project(
+            project_context,
+            project_data['project_abs'],
+            project_data['subdirectory'],
+        )
+        message(project_context, '------ Exiting  {} -------'.format(name), '')
 
-            if not converted:
-                continue
+        if not converted:
+            return None
 
-            project_context = project_data['project_context']
-            # Can't return context as a result due PicklingError
-            results.append(
-                {
-                    'cmake': project_context.cmake,
-                    'project_name': project_context.project_name,
-                    'solution_languages': project_context.solution_languages,
-                    'target_windows_ver': project_context.target_windows_version,
-                    'warnings_count': project_context.warnings_count
-                }
-            )
-        return results
+        # Can't return context as a result due PicklingError
+        return {
+            'cmake': project_context.cmake,
+            'project_name': project_context.project_name,
+            'solution_languages': project_context.solution_languages,
+            'target_windows_ver': project_context.target_windows_version,
+            'warnings_count': project_context.warnings_count
+        }
 
     def do_conversion(self, root_context, input_data_for_converter):
         """ Executes conversion with given projects input data """
@@ -323,8 +409,11 @@ class DataConverter:
 
         results = []
         if root_context.jobs > 1:
-            pool = Pool(root_context.jobs)
-            results = pool.map(self.run_conversion, input_converter_data_list)
+            chunksize = max(1, len(input_converter_data_list) // (root_context.jobs * 4))
+            with Pool(root_context.jobs) as pool:
+                results = list(
+                    pool.imap(self.run_conversion, input_converter_data_list, chunksize)
+                )
         else:   # do in main thread
             for data_for_converter in input_converter_data_list:
                 results.append(self.run_conversion(data_for_converter))
@@ -420,24 +509,17 @@ class DataConverter:
 
     @staticmethod
     def __write_supported_architectures_check(context, cmake_file):
-        arch_list = list(context.supported_architectures)
-        arch_list.sort()
-        cmake_file.write('if(NOT (')
-        first = True
-        for arch in arch_list:
-            if first:
-                cmake_file.write('\"${{CMAKE_VS_PLATFORM_NAME}}\" STREQUAL \"{}\"'
-                                 .format(arch))
-                first = False
-            else:
-                cmake_file.write('\n{} OR \"${{CMAKE_VS_PLATFORM_NAME}}\" STREQUAL \"{}\"'
-                                 .format(context.indent, arch))
-        cmake_file.write('))\n')
+        indent = context.indent
+        arch_checks = [
+            f'\"${{CMAKE_VS_PLATFORM_NAME}}\" STREQUAL \"{arch}\"'
+            for arch in sorted(context.supported_architectures)
+        ]
         cmake_file.write(
-            '{}message(FATAL_ERROR "${{CMAKE_VS_PLATFORM_NAME}} arch is not supported!")\n'
-            .format(context.indent)
+            'if(NOT (' + f'\n{indent} OR '.join(arch_checks) + '))\n'
+            f'{indent}message(FATAL_ERROR '
+            '"${CMAKE_VS_PLATFORM_NAME} arch is not supported!")\n'
+            'endif()\n\n'
         )
-        cmake_file.write('endif()\n\n')
 
     @staticmethod
     def copy_cmake_utils(cmake_lists_path):
@@ -445,16 +527,18 @@ class DataConverter:
         utils_path = os.path.join(cmake_lists_path, 'CMake')
         if not os.path.exists(utils_path):
             os.makedirs(utils_path)
-        src_dir = os.path.dirname(os.path.abspath(__file__))
-        shutil.copyfile(os.path.join(src_dir, 'utils.cmake'), utils_path + '/Utils.cmake')
+        with open(utils_path + '/Utils.cmake', 'wb') as utils_file:
+            utils_file.write(get_utils_cmake_contents())
 
     @staticmethod
     def __write_global_configuration_types(context, root_cmake, configuration_types_list):
         write_comment(root_cmake, 'Global configuration types')
-        root_cmake.write('set(CMAKE_CONFIGURATION_TYPES\n')
+        indent = context.indent
+        parts = ['set(CMAKE_CONFIGURATION_TYPES\n']
         for configuration_type in configuration_types_list:
-            root_cmake.write('{}\"{}\"\n'.format(context.indent, configuration_type))
-        root_cmake.write('{}CACHE STRING "" FORCE\n)\n\n'.format(context.indent))
+            parts.append(f'{indent}\"{configuration_type}\"\n')
+        parts.append(f'{indent}CACHE STRING "" FORCE\n)\n\n')
+        root_cmake.write(''.join(parts))
 
     def __write_global_compile_options(self, root_context, root_cmake, configuration_types_list):
         write_comment(root_cmake, 'Global compiler options')
@@ -487,48 +571,50 @@ class DataConverter:
     def __write_global_compile_options_language(
             context, root_cmake, configuration_types_list, lang
     ):
-        root_cmake.write('{}set(CMAKE_{}_FLAGS "")\n'.format(context.indent, lang))
+        indent = context.indent
+        parts = [f'{indent}set(CMAKE_{lang}_FLAGS "")\n']
         for configuration_type in configuration_types_list:
-            root_cmake.write('{}set(CMAKE_{}_FLAGS_{} "")\n'
-                             .format(context.indent, lang, configuration_type.upper()))
+            parts.append(f'{indent}set(CMAKE_{lang}_FLAGS_{configuration_type.upper()} "")\n')
+        root_cmake.write(''.join(parts))
 
     @staticmethod
     def __write_global_link_options(context, root_cmake, configuration_types_list):
         write_comment(root_cmake, 'Global linker options')
-        root_cmake.write('if(MSVC)\n')
-        root_cmake.write(
-            '{}# remove default flags provided with CMake for MSVC\n'.format(context.indent)
-        )
-        root_cmake.write('{}set(CMAKE_EXE_LINKER_FLAGS "")\n'.format(context.indent))
-        root_cmake.write('{}set(CMAKE_MODULE_LINKER_FLAGS "")\n'.format(context.indent))
-        root_cmake.write('{}set(CMAKE_SHARED_LINKER_FLAGS "")\n'.format(context.indent))
-        root_cmake.write('{}set(CMAKE_STATIC_LINKER_FLAGS "")\n'.format(context.indent))
+        indent = context.indent
+        parts = [
+            'if(MSVC)\n',
+            f'{indent}# remove default flags provided with CMake for MSVC\n',
+            f'{indent}set(CMAKE_EXE_LINKER_FLAGS "")\n',
+            f'{indent}set(CMAKE_MODULE_LINKER_FLAGS "")\n',
+            f'{indent}set(CMAKE_SHARED_LINKER_FLAGS "")\n',
+            f'{indent}set(CMAKE_STATIC_LINKER_FLAGS "")\n',
+        ]
         for configuration_type in configuration_types_list:
             ct_upper = configuration_type.upper()
-            root_cmake.write(
-                '{}set(CMAKE_EXE_LINKER_FLAGS_{} \"${{CMAKE_EXE_LINKER_FLAGS}}\")\n'
-                .format(context.indent, ct_upper))
-            root_cmake.write(
-                '{}set(CMAKE_MODULE_LINKER_FLAGS_{} \"${{CMAKE_MODULE_LINKER_FLAGS}}\")\n'
-                .format(context.indent, ct_upper))
-            root_cmake.write(
-                '{}set(CMAKE_SHARED_LINKER_FLAGS_{} \"${{CMAKE_SHARED_LINKER_FLAGS}}\")\n'
-                .format(context.indent, ct_upper))
-            root_cmake.write(
-                '{}set(CMAKE_STATIC_LINKER_FLAGS_{} \"${{CMAKE_STATIC_LINKER_FLAGS}}\")\n'
-                .format(context.indent, ct_upper))
-        root_cmake.write('endif()\n\n')
+            parts.append(
+                f'{indent}set(CMAKE_EXE_LINKER_FLAGS_{ct_upper}'
+                ' \"${CMAKE_EXE_LINKER_FLAGS}\")\n'
+                f'{indent}set(CMAKE_MODULE_LINKER_FLAGS_{ct_upper}'
+                ' \"${CMAKE_MODULE_LINKER_FLAGS}\")\n'
+                f'{indent}set(CMAKE_SHARED_LINKER_FLAGS_{ct_upper}'
+                ' \"${CMAKE_SHARED_LINKER_FLAGS}\")\n'
+                f'{indent}set(CMAKE_STATIC_LINKER_FLAGS_{ct_upper}'
+                ' \"${CMAKE_STATIC_LINKER_FLAGS}\")\n'
+            )
+        parts.append('endif()\n\n')
+        root_cmake.write(''.join(parts))
 
     @staticmethod
     def __write_subdirectories(root_cmake, subdirectories_set, subdirectories_to_project_name):
         write_comment(root_cmake, 'Sub-projects')
         subdirectories = list(subdirectories_set)
         subdirectories.sort(key=str.lower)
+        parts = []
         for subdirectory in subdirectories:
             binary_dir = ''
             if '.' in subdirectory[:1]:
-                binary_dir = ' ${{CMAKE_BINARY_DIR}}/{}'.format(
-                    subdirectories_to_project_name[subdirectory])
-            root_cmake.write('add_subdirectory({}{})\n'.format(
-                set_unix_slash(subdirectory), binary_dir))
-        root_cmake.write('\n')
+                binary_dir = \
+                    ' ${CMAKE_BINARY_DIR}/' + subdirectories_to_project_name[subdirectory]
+            parts.append(f'add_subdirectory({set_unix_slash(subdirectory)}{binary_dir})\n')
+        parts.append('\n')
+        root_cmake.write(''.join(parts))
@@ -64,7 +64,7 @@ setup(
     zip_safe=False,
 
     packages=find_packages(),
-    python_requires='>=3.5',
+    python_requires='>=3.7',
     include_package_data=True,
 
     install_requires=install_requires,
@@ -79,8 +79,6 @@ setup(
         'Natural Language :: English',
         'Operating System :: OS Independent',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Topic :: Software Development :: Build Tools',
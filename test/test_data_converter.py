@@ -27,6 +27,18 @@ from cmake_converter.data_converter import DataConverter
 from cmake_converter.visual_studio.context import VSContext
 
 
+class StubMergeUtils:
+    """ Minimal utils stub exposing the hooks used by merge_data_settings """
+
+    @staticmethod
+    def lists_of_settings_to_merge():
+        return ['defines']
+
+    @staticmethod
+    def init_context_current_setting(context):
+        context.settings[context.current_setting] = {'defines': []}
+
+
 class TestDataConverter(unittest.TestCase):
     """
         This file test methods of DataConverter class.
@@ -35,6 +47,52 @@ class TestDataConverter(unittest.TestCase):
     cur_dir = os.path.dirname(os.path.realpath(__file__))
     vs_project = '%s/datatest/foo.vcxproj' % cur_dir
 
+    @staticmethod
+    def make_merge_context(sln_configurations_map, settings):
+        """ Builds a context holding only what merge_data_settings touches """
+        context = VSContext()
+        context.utils = StubMergeUtils()
+        context.sln_configurations_map = dict(sln_configurations_map)
+        context.settings = settings
+        return context
+
+    def test_merge_data_settings_orders_common_settings(self):
+        """Merge Keeps Common Settings Order And Removes Them From Configurations"""
+
+        under_test = self.make_merge_context(
+            {('Debug', 'x64'): ('Debug', 'x64'), ('Release', 'x64'): ('Release', 'x64')},
+            {
+                ('Debug', 'x64'): {'defines': ['A', 'B', 'D']},
+                ('Release', 'x64'): {'defines': ['A', 'C', 'D']},
+            }
+        )
+
+        DataConverter().merge_data_settings(under_test)
+
+        # intersection goes to the arch-global setting, in round-robin order
+        self.assertEqual(['A', 'D'], under_test.settings[(None, 'x64')]['defines'])
+        self.assertEqual(['B'], under_test.settings[('Debug', 'x64')]['defines'])
+        self.assertEqual(['C'], under_test.settings[('Release', 'x64')]['defines'])
+        self.assertEqual(
+            (None, 'x64'), under_test.sln_configurations_map[(None, 'x64')]
+        )
+
+    def test_merge_data_settings_shared_mapped_setting(self):
+        """Merge Handles Solution Configurations Mapped To The Same Project Setting"""
+
+        under_test = self.make_merge_context(
+            {('Debug', 'Win32'): ('Debug', 'Win32'), ('Debug', 'x64'): ('Debug', 'Win32')},
+            {('Debug', 'Win32'): {'defines': ['A', 'B']}}
+        )
+
+        DataConverter().merge_data_settings(under_test)
+
+        # each arch has a single configuration: everything becomes common
+        self.assertEqual(['A', 'B'], under_test.settings[(None, 'Win32')]['defines'])
+        self.assertEqual(['A', 'B'], under_test.settings[(None, 'x64')]['defines'])
+        self.assertEqual([], under_test.settings[('Debug', 'Win32')]['defines'])
+        self.assertEqual([], under_test.settings[('Debug', 'x64')]['defines'])
+
     def test_context_init(self):
         """Data Converter Init Files"""
 